@@ -3,19 +3,115 @@ Multi-level activity recording addon for mitmproxy.
 
 Levels:
 1. Network-only: HAR export (for Integuru)
-2. Full bodies: Request/response content
+2. Full bodies: Request/response headers and content
 3. Timing data: Performance metrics
 4. WebSocket: Real-time protocol messages
 """
 
+import functools
+import gzip
 import json
 import logging
+import logging.handlers
 import os
+import queue
 import sys
+import threading
+import time
 from pathlib import Path
 from datetime import datetime
 from mitmproxy import http, websocket, ctx
 from mitmproxy.addons import save
+from mitmproxy.net.http.headers import parse_content_type
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Large write buffer under each output file so compressed stream chunks
+# are coalesced into few syscalls
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Maximum queued lines the writer thread coalesces into one pass
+WRITER_BATCH_SIZE = 64
+
+# Maximum encoded lines waiting for the writer; hooks block once it is full so
+# a stalled disk applies backpressure instead of growing memory without bound
+WRITER_QUEUE_SIZE = 8192
+
+
+def _json_default(obj):
+    """Serialize mitmproxy objects the JSON encoders don't handle natively."""
+    if isinstance(obj, http.Headers):
+        # Ordered [name, value] pairs, keeping repeated headers like Set-Cookie
+        return list(obj.items(multi=True))
+    if isinstance(obj, os.PathLike):
+        return os.fspath(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+# fdatasync is unavailable on some platforms (e.g. macOS)
+_fdatasync = getattr(os, "fdatasync", os.fsync)
+
+
+def _dump(path, obj):
+    """Atomically write obj to path as indented JSON, using orjson when available.
+    
+    Data goes to a temporary file that is synced and then renamed over path,
+    so a crash mid-write never leaves a truncated file behind.
+    """
+    if orjson is not None:
+        payload = orjson.dumps(obj, default=_json_default, option=orjson.OPT_INDENT_2)
+    else:
+        payload = json.dumps(obj, default=_json_default, indent=2).encode("utf-8")
+    
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+            f.write(payload)
+            f.flush()
+            _fdatasync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _open_gzip_stream(path):
+    """Open a level 1 gzip stream on top of a WRITE_BUFFER_SIZE-buffered file.
+    
+    Returns (raw, gz); GzipFile does not close a file it was handed, so
+    callers close gz and then raw.
+    """
+    raw = open(path, "wb", buffering=WRITE_BUFFER_SIZE)
+    return raw, gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=1)
+
+
+def _body_preview(message, content):
+    """Decode the first 500 bytes of a body using its declared charset, defaulting to UTF-8."""
+    charset = "utf-8"
+    content_type = message.headers.get("content-type")
+    if content_type:
+        parsed = parse_content_type(content_type)
+        if parsed:
+            charset = parsed[2].get("charset", charset)
+    try:
+        return content[:500].decode(charset, errors='replace')
+    except LookupError:
+        return content[:500].decode('utf-8', errors='replace')
+
+
+if orjson is not None:
+    # Bound once so the hot path is a single C call that also appends the newline
+    _encode_line = functools.partial(orjson.dumps, default=_json_default, option=orjson.OPT_APPEND_NEWLINE)
+else:
+    def _encode_line(obj):
+        """Serialize obj to one newline-terminated NDJSON line."""
+        return json.dumps(obj, default=_json_default).encode("utf-8") + b"\n"
 
 class LayeredRecorder:
     def __init__(self, record_level=3):
@@ -27,19 +123,38 @@ class LayeredRecorder:
         self.session_dir.mkdir(parents=True, exist_ok=True)
         
         # Initialize data structures
-        self.network_log = []
         self.har_data = None
-        self.performance_metrics = {}
-        self.websocket_messages = []
         self.request_timestamps = {}
+        self.start_time = None
+        
+        # Stream entries to gzipped NDJSON files as they arrive instead of holding them in memory
+        self.network_file = self.session_dir / "network_activity.ndjson.gz"
+        self.metrics_file = self.session_dir / "performance_metrics.ndjson.gz"
+        self.ws_file = self.session_dir / "websocket_messages.ndjson.gz"
+        self.log_file = self.session_dir / "recorder.log"
+        self.summary_file = self.session_dir / "session_summary.json"
+        self._net_raw, self._net_fp = _open_gzip_stream(self.network_file)
+        self._perf_raw, self._perf_fp = _open_gzip_stream(self.metrics_file)
+        self._ws_raw, self._ws_fp = _open_gzip_stream(self.ws_file)
+        self._req_count = 0
+        self._resp_count = 0
+        self._perf_count = 0
+        self._ws_count = 0
         
-        # Set up logging
+        # Disk writes happen on a background thread so hooks never block on I/O
+        self._write_queue = queue.Queue(maxsize=WRITER_QUEUE_SIZE)
+        self._writer = threading.Thread(target=self._writer_loop, name="LayeredRecorderWriter", daemon=True)
+        self._writer.start()
+        
+        # Set up logging; records are buffered in memory and flushed to the file in bulk
         self.logger = logging.getLogger("LayeredRecorder")
-        handler = logging.FileHandler(self.session_dir / "recorder.log")
+        handler = logging.FileHandler(self.log_file)
         formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
         handler.setFormatter(formatter)
-        self.logger.addHandler(handler)
-        self.logger.setLevel(logging.DEBUG)
+        self._log_handler = logging.handlers.MemoryHandler(capacity=1024, target=handler)
+        self.logger.addHandler(self._log_handler)
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
         
         self.logger.info(f"LayeredRecorder initialized with level {self.record_level}")
         self.logger.info(f"Session directory: {self.session_dir}")
@@ -56,152 +171,217 @@ class LayeredRecorder:
     
     def requestheaders(self, flow):
         """Level 1+: Log request metadata."""
-        timestamp = datetime.now()
-        self.request_timestamps[flow.id] = timestamp
+        if self.record_level < 1:
+            return
+        
+        timestamp = time.time()
+        self.request_timestamps[flow.id] = time.monotonic()
         
         request_entry = {
-            "timestamp": timestamp.isoformat(),
+            "timestamp": timestamp,
             "type": "request",
             "method": flow.request.method,
             "url": flow.request.url,
-            "headers": dict(flow.request.headers),
             "http_version": flow.request.http_version,
             "flow_id": flow.id
         }
         
-        # Level 2+: Include request body
-        if self.record_level >= 2 and hasattr(flow.request, 'content') and flow.request.content:
-            request_entry["body_size"] = len(flow.request.content)
-            try:
-                request_entry["body_preview"] = flow.request.text[:500]
-            except:
-                request_entry["body_preview"] = "[binary data]"
+        # Level 2+: Include request headers and body
+        if self.record_level >= 2:
+            request_entry["headers"] = flow.request.headers
+            content = getattr(flow.request, 'content', None)
+            if content:
+                request_entry["body_size"] = len(content)
+                request_entry["body_preview"] = _body_preview(flow.request, content)
         
-        self.network_log.append(request_entry)
-        self.logger.debug(f"Request logged: {flow.request.method} {flow.request.url}")
+        if self.start_time is None:
+            self.start_time = timestamp
+        self._write_entry(self._net_fp, request_entry)
+        self._req_count += 1
+        self.logger.debug("Request logged: %s %s", flow.request.method, flow.request.url)
     
     def response(self, flow):
         """Level 1+: Log response metadata."""
-        timestamp = datetime.now()
+        if self.record_level < 1:
+            return
         
-        # Calculate timing
-        duration_ms = None
-        if flow.id in self.request_timestamps:
-            duration_ms = (timestamp - self.request_timestamps[flow.id]).total_seconds() * 1000
+        timestamp = time.time()
+        
+        # Calculate timing; pop so finished flows don't accumulate
+        t0 = self.request_timestamps.pop(flow.id, None)
+        duration_ms = None if t0 is None else (time.monotonic() - t0) * 1000.0
         
         response_entry = {
-            "timestamp": timestamp.isoformat(),
+            "timestamp": timestamp,
             "type": "response",
             "status_code": flow.response.status_code,
-            "headers": dict(flow.response.headers),
             "http_version": flow.response.http_version,
             "duration_ms": duration_ms,
             "url": flow.request.url,
             "flow_id": flow.id
         }
         
-        # Level 2+: Include response body
-        if self.record_level >= 2 and hasattr(flow.response, 'content') and flow.response.content:
-            response_entry["body_size"] = len(flow.response.content)
-            try:
-                response_entry["body_preview"] = flow.response.text[:500]
-            except:
-                response_entry["body_preview"] = "[binary data]"
+        # Body is read once and shared with the level 3 metrics below
+        content = getattr(flow.response, 'content', None) if self.record_level >= 2 else None
+        
+        # Level 2+: Include response headers and body
+        if self.record_level >= 2:
+            response_entry["headers"] = flow.response.headers
+            if content:
+                response_entry["body_size"] = len(content)
+                response_entry["body_preview"] = _body_preview(flow.response, content)
+        
+        if self.start_time is None:
+            self.start_time = timestamp
+        self._write_entry(self._net_fp, response_entry)
+        self._resp_count += 1
         
         # Level 3+: Full performance metrics
         if self.record_level >= 3:
-            self.performance_metrics[flow.request.url] = {
+            self._write_entry(self._perf_fp, {
+                "url": flow.request.url,
                 "status": flow.response.status_code,
                 "response_time_ms": duration_ms,
-                "content_size_bytes": len(flow.response.content) if flow.response.content else 0,
+                "content_size_bytes": len(content) if content else 0,
                 "headers_count": len(flow.response.headers),
                 "request_method": flow.request.method,
-                "timestamp": timestamp.isoformat()
-            }
+                "timestamp": timestamp
+            })
+            self._perf_count += 1
         
-        self.network_log.append(response_entry)
-        self.logger.debug(f"Response logged: {flow.response.status_code} for {flow.request.url}")
+        self.logger.debug("Response logged: %s for %s", flow.response.status_code, flow.request.url)
+    
+    def error(self, flow):
+        """Called when a flow fails (reset, timeout, killed) without a response."""
+        self.request_timestamps.pop(flow.id, None)
     
     def websocket_message(self, flow):
         """Level 4: Log WebSocket messages."""
         if self.record_level >= 4:
+            timestamp = time.time()
             for message in flow.messages:
                 ws_entry = {
-                    "timestamp": datetime.now().isoformat(),
+                    "timestamp": timestamp,
                     "type": "websocket",
                     "direction": "client_to_server" if message.from_client else "server_to_client",
                     "message": message.content.decode('utf-8', errors='replace')[:1000],
                     "flow_id": flow.id,
                     "url": flow.request.url
                 }
-                self.websocket_messages.append(ws_entry)
-                self.logger.debug(f"WebSocket message logged: {ws_entry['direction']}")
+                self._write_entry(self._ws_fp, ws_entry)
+                self._ws_count += 1
+                self.logger.debug("WebSocket message logged: %s", ws_entry["direction"])
     
     def websocket_end(self, flow):
         """Called when WebSocket connection ends."""
         if self.record_level >= 4:
             self.logger.info(f"WebSocket connection ended for {flow.request.url}")
     
+    def _write_entry(self, fp, entry):
+        """Queue one entry as an NDJSON line for the writer thread."""
+        try:
+            line = _encode_line(entry)
+        except TypeError:
+            # orjson rejects lone surrogates, which mitmproxy produces when it decodes
+            # non-UTF-8 header or URL bytes with surrogateescape; stdlib json escapes them
+            line = json.dumps(entry, default=_json_default).encode("utf-8") + b"\n"
+        self._write_queue.put((fp, line))
+    
+    def _writer_loop(self):
+        """Drain queued lines to their streams, one write per stream per batch.
+        
+        A stream that fails to write is logged once and its later lines are
+        dropped, so the thread keeps draining the queue and hooks never block on it.
+        """
+        failed = set()
+        while True:
+            batch = [self._write_queue.get()]
+            while len(batch) < WRITER_BATCH_SIZE:
+                try:
+                    batch.append(self._write_queue.get_nowait())
+                except queue.Empty:
+                    break
+            
+            pending = {}
+            stop = False
+            for item in batch:
+                if item is None:
+                    stop = True
+                    continue
+                fp, payload = item
+                pending.setdefault(fp, []).append(payload)
+            
+            for fp, payloads in pending.items():
+                if fp in failed:
+                    continue
+                try:
+                    fp.write(b"".join(payloads))
+                except Exception as e:
+                    failed.add(fp)
+                    self.logger.error(f"Error writing recorded data, dropping further entries for this stream: {str(e)}")
+            
+            if stop:
+                return
+    
     def done(self):
         """Save all recorded data on exit."""
+        # Must stay synchronous: mitmproxy invokes done() synchronously when a
+        # script addon is removed or hot-reloaded
         self.logger.info("Saving recorded data...")
         
         try:
-            # Save network log
-            network_file = self.session_dir / "network_activity.json"
-            with open(network_file, "w") as f:
-                json.dump(self.network_log, f, indent=2)
-            self.logger.info(f"Network activity saved: {network_file}")
-            
-            # Count requests and responses
-            request_count = len([x for x in self.network_log if x['type'] == 'request'])
-            response_count = len([x for x in self.network_log if x['type'] == 'response'])
-            self.logger.info(f"Total requests: {request_count}, Total responses: {response_count}")
+            # Let the writer drain its queue, then flush and close the NDJSON streams
+            self._write_queue.put(None)
+            self._writer.join()
+            for gz, raw in ((self._net_fp, self._net_raw),
+                            (self._perf_fp, self._perf_raw),
+                            (self._ws_fp, self._ws_raw)):
+                gz.close()
+                raw.close()
+            self.logger.info(f"Network activity saved: {self.network_file}")
+            self.logger.info(f"Total requests: {self._req_count}, Total responses: {self._resp_count}")
             
-            # Save performance metrics
-            if self.performance_metrics:
-                metrics_file = self.session_dir / "performance_metrics.json"
-                with open(metrics_file, "w") as f:
-                    json.dump(self.performance_metrics, f, indent=2)
-                self.logger.info(f"Performance metrics saved: {metrics_file}")
-                self.logger.info(f"Performance entries: {len(self.performance_metrics)}")
+            # Drop streams that never received an entry
+            if self._perf_count:
+                self.logger.info(f"Performance metrics saved: {self.metrics_file}")
+                self.logger.info(f"Performance entries: {self._perf_count}")
+            else:
+                self.metrics_file.unlink(missing_ok=True)
             
-            # Save WebSocket messages
-            if self.websocket_messages:
-                ws_file = self.session_dir / "websocket_messages.json"
-                with open(ws_file, "w") as f:
-                    json.dump(self.websocket_messages, f, indent=2)
-                self.logger.info(f"WebSocket messages saved: {ws_file}")
-                self.logger.info(f"WebSocket entries: {len(self.websocket_messages)}")
+            if self._ws_count:
+                self.logger.info(f"WebSocket messages saved: {self.ws_file}")
+                self.logger.info(f"WebSocket entries: {self._ws_count}")
+            else:
+                self.ws_file.unlink(missing_ok=True)
             
             # Create session summary
             summary = {
                 "session_id": self.session_dir.name,
                 "record_level": self.record_level,
-                "start_time": self.network_log[0]["timestamp"] if self.network_log else None,
+                "start_time": datetime.fromtimestamp(self.start_time).isoformat() if self.start_time is not None else None,
                 "end_time": datetime.now().isoformat(),
-                "total_requests": request_count,
-                "total_responses": response_count,
-                "performance_metrics_count": len(self.performance_metrics),
-                "websocket_messages_count": len(self.websocket_messages),
+                "total_requests": self._req_count,
+                "total_responses": self._resp_count,
+                "performance_metrics_count": self._perf_count,
+                "websocket_messages_count": self._ws_count,
                 "files": {
-                    "network_activity": str(network_file),
-                    "performance_metrics": str(self.session_dir / "performance_metrics.json") if self.performance_metrics else None,
-                    "websocket_messages": str(self.session_dir / "websocket_messages.json") if self.websocket_messages else None,
-                    "recorder_log": str(self.session_dir / "recorder.log")
+                    "network_activity": self.network_file,
+                    "performance_metrics": self.metrics_file if self._perf_count else None,
+                    "websocket_messages": self.ws_file if self._ws_count else None,
+                    "recorder_log": self.log_file
                 }
             }
             
-            summary_file = self.session_dir / "session_summary.json"
-            with open(summary_file, "w") as f:
-                json.dump(summary, f, indent=2)
+            _dump(self.summary_file, summary)
             
-            self.logger.info(f"Session summary saved: {summary_file}")
+            self.logger.info(f"Session summary saved: {self.summary_file}")
             self.logger.info("LayeredRecorder session completed successfully")
             
         except Exception as e:
             self.logger.error(f"Error saving recorded data: {str(e)}")
             raise
+        finally:
+            self._log_handler.flush()
 
 # Addon configuration
 addons = [LayeredRecorder(record_level=3)]
\ No newline at end of file